@@ -12,7 +12,6 @@ def get_version(rel_path):
 VERSION=get_version("unishell/__init__.py")
 
 REQUIREMENTS = [
-    'termcolor>=1.1.0',
     'paramiko>=2.4.0',
     'uritools>=2.1.0',
     'pyserial>=3.4',
@@ -40,7 +39,6 @@ setup(
     keywords=["shell", "ssh", "serial", "local", "remote"],
     download_url="https://github.com/Raphael-Marx/unishell/archive/" + VERSION + ".tar.gz",
     install_requires=[
-        'termcolor>=1.1.0',
         'paramiko>=2.4.0',
         'uritools>=2.1.0',
         'pyserial>=3.4',
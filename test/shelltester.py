@@ -1,7 +1,7 @@
 from pytest import mark, raises, skip
 from unishell import ShellError, sh
 from itertools import product
-from logging import INFO, ERROR, DEBUG, CRITICAL
+from logging import INFO, ERROR, DEBUG, CRITICAL, getLogger
 from backports.tempfile import TemporaryDirectory
 from tempfile import NamedTemporaryFile
 from os import path, stat
@@ -141,6 +141,18 @@ class AbstractShellTester:
         assert shell("echo $VAR", VAR="bar") == "bar"
         assert shell("echo $VAR") == "foo"
 
+    def test_shell_sees_environment_updates_between_commands(self):
+        # NOTE: the environment is modified, do not use a cached shell
+        shell = self.instanciate_new_shell(VAR="foo")
+        assert shell("echo $VAR") == "foo"
+        shell.update(VAR="bar", OTHER="baz")
+        assert shell("echo $VAR $OTHER") == "bar baz"
+        shell.pop("OTHER")
+        assert shell("echo $VAR $OTHER") == "bar"
+        shell.setdefault("VAR", "ignored")
+        shell.clear()
+        assert shell("echo $VAR") == ""
+
     @mark.parametrize("global_check_xc,local_check_xc", [ (True, True), (True, False), (False, True), (False, False) ])
     def test_shell_check_xc_raises(self, global_check_xc, local_check_xc):
         shell = self.get_shell(check_xc=global_check_xc)
@@ -213,6 +225,19 @@ class AbstractShellTester:
         assert in_index < out_index
         assert in_index < err_index
 
+    def test_shell_logs_at_level_configured_after_construction(self, caplog):
+        shell = self.instanciate_new_shell()
+        caplog.set_level(INFO, logger="%s.in" % str(shell))
+        shell("echo hi")
+        assert ("%s.in" % str(shell), INFO, "echo hi") in caplog.record_tuples
+
+    def test_shell_set_log_level_applies_to_loggers_not_used_yet(self):
+        shell = self.instanciate_new_shell()
+        getLogger("%s.out" % str(shell)).setLevel(ERROR)
+        shell.set_log_level(INFO)
+        shell("echo hi")
+        assert getLogger("%s.out" % str(shell)).level == INFO
+
     def test_shell_command_with_single_quotes(self):
         shell = self.get_shell()
         assert shell("echo '$FOO'", FOO="foo") == "$FOO"
@@ -247,6 +272,19 @@ class AbstractShellTester:
         finally:
             shell("rm %s" % remote_path)
 
+    def test_shell_cached_permissions_after_push_match_remote_file(self):
+        shell = self.get_shell()
+        remote_path = self.get_test_remote_path(shell)
+        with NamedTemporaryFile() as temp_file:
+            chmod(temp_file.name, 0o4755)
+            shell.push(temp_file.name, remote_path)
+        try:
+            cached = shell.get_permissions(remote_path)
+            assert shell("true")
+            assert shell.get_permissions(remote_path) == cached
+        finally:
+            shell("rm %s" % remote_path)
+
     def test_shell_can_push_file(self):
         shell = self.get_shell()
         content = "this is a file\n"
@@ -330,3 +368,101 @@ class AbstractShellTester:
         assert up is not None
         cwd = shell("pwd", cwd=up).stdout()[0]
         assert cwd == up
+
+    def test_shell_can_batch_commands(self):
+        shell = self.get_shell()
+        results = shell.batch(["echo Foo", ">&2 echo Bar", "exit 13", "echo -n Baz", "echo; echo"])
+        assert [result.stdout() for result in results] == [["Foo"], [], [], ["Baz"], ["", ""]]
+        assert [result.stderr() for result in results] == [[], ["Bar"], [], [], []]
+        assert [result.exit_code() for result in results] == [0, 0, 13, 0, 0]
+
+    def test_shell_batched_commands_are_independent(self):
+        shell = self.get_shell()
+        cwd = shell("pwd").stdout()[0]
+        up = path.split(cwd)[0]
+        results = shell.batch(["cd %s; FOO=foo; pwd" % up, "pwd; echo $FOO"], FOO="bar")
+        assert results[0] == up
+        assert results[1].stdout() == [cwd, "bar"]
+
+    def test_shell_batch_logs_each_command_once(self, caplog):
+        shell = self.get_shell()
+        base_logger = str(shell)
+        caplog.set_level(INFO, logger="%s.in" % base_logger)
+        caplog.set_level(INFO, logger="%s.out" % base_logger)
+        caplog.set_level(INFO, logger="%s.err" % base_logger)
+
+        shell.batch(["echo Foo", ">&2 echo Bar"])
+        assert caplog.record_tuples == [
+            ('%s.in' % base_logger, INFO, "echo Foo"),
+            ('%s.out' % base_logger, INFO, "Foo"),
+            ('%s.in' % base_logger, INFO, ">&2 echo Bar"),
+            ('%s.err' % base_logger, ERROR, "Bar"),
+        ]
+
+    def test_shell_batch_honours_check_xc_and_check_err(self):
+        shell = self.get_shell(check_xc=True)
+        with raises(ShellError):
+            shell.batch(["echo Foo", "exit 3"])
+        assert [result.exit_code() for result in shell.batch(["exit 3"], check_xc=False)] == [3]
+        with raises(ShellError):
+            self.get_shell().batch([">&2 echo Bar"], check_err=True)
+
+    def test_shell_wait_after_batch(self):
+        shell = self.get_shell()
+        shell("sleep 1", wait=False)
+        shell.batch(["echo Foo"])
+        start = time()
+        shell.wait()
+        assert time() - start < .5
+
+    def test_shell_permissions_cache_is_invalidated_by_commands(self):
+        shell = self.get_shell()
+        remote_path = self.get_test_remote_path(shell)
+        assert shell("touch %s" % remote_path)
+        try:
+            shell.set_permissions(remote_path, 0o640)
+            assert shell.get_permissions(remote_path) == 0o640
+            assert shell("chmod 600 %s" % remote_path)
+            assert shell.get_permissions(remote_path) == 0o600
+        finally:
+            shell("rm %s" % remote_path)
+
+    def test_shell_can_get_permissions_of_path_with_quotes_and_spaces(self):
+        shell = self.get_shell()
+        remote_path = self.get_test_remote_path(shell) + " it's"
+        assert shell("touch \"%s\" && chmod 751 \"%s\"" % (remote_path, remote_path))
+        try:
+            assert shell.get_permissions(remote_path) == 0o751
+        finally:
+            shell("rm \"%s\"" % remote_path)
+
+    def test_shell_md5_of_file(self):
+        shell = self.get_shell()
+        remote_path = self.get_test_remote_path(shell)
+        assert shell("echo -n 'this is a file' > %s" % remote_path)
+        try:
+            assert shell.md5(remote_path) == "139ec4f94a8c908e20e7c2dce5092af4"
+        finally:
+            shell("rm %s" % remote_path)
+
+    def test_shell_md5_and_hexdump_of_path_with_quotes_and_spaces(self):
+        shell = self.get_shell()
+        remote_path = self.get_test_remote_path(shell) + " it's"
+        assert shell("echo -n 'this is a file' > \"%s\"" % remote_path)
+        try:
+            assert shell.md5(remote_path) == "139ec4f94a8c908e20e7c2dce5092af4"
+            assert shell.hexdump(remote_path) == "this is a file".encode("utf-8").hex()
+        finally:
+            shell("rm \"%s\"" % remote_path)
+
+    def test_shell_command_is_executed_in_cwd_with_spaces(self):
+        shell = self.get_shell()
+        with TemporaryDirectory(suffix=" it's") as sandbox:
+            assert shell("pwd", cwd=sandbox).stdout() == [sandbox]
+
+    def test_shell_no_wait_returns_before_exit_code_is_known(self):
+        shell = self.get_shell()
+        start = time()
+        result = shell("sleep .5; exit 3", wait=False)
+        assert time() - start < .4
+        assert result.exit_code() == 3
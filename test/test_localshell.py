@@ -1,6 +1,8 @@
 from pytest import mark, raises, skip
 from time import time
-from os import environ
+from os import environ, path, symlink
+from shutil import which
+from backports.tempfile import TemporaryDirectory
 
 from unishell import LocalShell, ShellError, sh
 from shelltester import AbstractShellTester
@@ -18,4 +20,18 @@ class TestLocalShell(AbstractShellTester):
 
     def test_local_shell_can_access_os_environ_by_default(self):
         shell_value = environ["SHELL"]
-        assert sh("echo $SHELL") == shell_value
\ No newline at end of file
+        assert sh("echo $SHELL") == shell_value
+
+    def test_local_shell_keeps_environment_apart_from_its_attributes(self):
+        shell = LocalShell(FOO="bar")
+        assert not hasattr(shell, "__dict__")
+        assert shell["FOO"] == "bar"
+        assert "_check_xc" not in shell
+
+    def test_local_shell_get_command_trusts_probe_over_os(self):
+        with TemporaryDirectory() as sandbox:
+            symlink(which("uname"), path.join(sandbox, "uname"))
+            shell = LocalShell()
+            shell["PATH"] = sandbox
+            with raises(RuntimeError):
+                shell.md5("/dev/null", mandatory=True)
@@ -4,6 +4,8 @@ from pytest import mark, raises, skip
 from unishell import SecureShell
 from shelltester import AbstractShellTester
 from backports.tempfile import TemporaryDirectory
+from tempfile import NamedTemporaryFile
+from os import chmod
 from uuid import uuid4
 
 class TestSecureShell(AbstractShellTester):
@@ -18,3 +20,27 @@ class TestSecureShell(AbstractShellTester):
         password = environ.get("TEST_SSH_PASS", None)
         port = int(environ.get("TEST_SSH_PORT", 22))
         return SecureShell(hostname, username=username, password=password, port=port, *args, **kwargs)
+
+    def test_secure_shell_permissions_of_directory_after_push_into_it(self):
+        shell = self.get_shell()
+        remote_dir = self.get_test_remote_path(shell)
+        assert shell("mkdir %s && chmod 700 %s" % (remote_dir, remote_dir))
+        try:
+            assert shell.get_permissions(remote_dir) == 0o700
+            with NamedTemporaryFile() as temp_file:
+                chmod(temp_file.name, 0o644)
+                shell.push(temp_file.name, remote_dir)
+            assert shell.get_permissions(remote_dir) == 0o700
+        finally:
+            shell("rm -r %s" % remote_dir)
+
+
+class TestInteractiveSecureShell(TestSecureShell):
+
+    def instanciate_new_shell(self, *args, **kwargs):
+        return super().instanciate_new_shell(*args, interactive=True, **kwargs)
+
+    def test_interactive_shell_survives_syntax_errors(self):
+        shell = self.get_shell()
+        assert shell('echo "foo').exit_code() != 0
+        assert shell("echo bar") == "bar"
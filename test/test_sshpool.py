@@ -0,0 +1,128 @@
+from unishell import sshpool, secureshell
+from unishell.sshpool import SSHConnectionPool
+from unishell.secureshell import SecureShell
+from paramiko import ChannelException
+from pytest import fixture
+
+
+class FakeTransport:
+
+    # NOTE: same as the default MaxSessions of OpenSSH
+    max_sessions = 10
+
+    def __init__(self):
+        self.active = True
+        self.sessions = 0
+
+    def is_active(self):
+        return self.active
+
+    def getpeername(self):
+        return ("127.0.0.1", 22)
+
+    def open_session(self):
+        if self.sessions >= self.max_sessions:
+            raise ChannelException(2, "Connect failed")
+        self.sessions += 1
+        return object()
+
+
+class FakeClient:
+
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.connections = 0
+        self.closed = False
+
+    def set_missing_host_key_policy(self, policy):
+        pass
+
+    def connect(self, **kwargs):
+        self.connections += 1
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        self.closed = True
+        self.transport.active = False
+
+
+@fixture
+def ssh_pool(monkeypatch):
+    monkeypatch.setattr(sshpool, "SSHClient", FakeClient)
+    return SSHConnectionPool(idle_ttl=0)
+
+
+def test_pool_reuses_connection_for_same_target(ssh_pool):
+    key1, client1 = ssh_pool.acquire("host", 22, "john", "secret")
+    key2, client2 = ssh_pool.acquire("host", 22, "john", "secret")
+    assert key1 == key2
+    assert client1 is client2
+    assert client1.connections == 1
+
+def test_pool_does_not_share_connection_between_credentials(ssh_pool):
+    _, client1 = ssh_pool.acquire("host", 22, "john", "secret")
+    _, client2 = ssh_pool.acquire("host", 22, "john", "other")
+    _, client3 = ssh_pool.acquire("host", 2222, "john", "secret")
+    assert client1 is not client2
+    assert client1 is not client3
+
+def test_pool_key_does_not_contain_password(ssh_pool):
+    key = ssh_pool.key("host", 22, "john", "secret")
+    assert "secret" not in key
+
+def test_pool_closes_connection_when_last_reference_is_released(ssh_pool):
+    key, client = ssh_pool.acquire("host", 22, "john", "secret")
+    ssh_pool.acquire("host", 22, "john", "secret")
+    ssh_pool.release(key, client)
+    assert not client.closed
+    ssh_pool.release(key, client)
+    assert client.closed
+
+def test_pool_replaces_dead_connection(ssh_pool):
+    key, client1 = ssh_pool.acquire("host", 22, "john", "secret")
+    client1.transport.active = False
+    _, client2 = ssh_pool.acquire("host", 22, "john", "secret")
+    assert client1 is not client2
+    ssh_pool.release(key, client1)
+    assert client1.closed
+    assert not client2.closed
+
+def test_pool_keeps_idle_connection_until_ttl(ssh_pool):
+    ssh_pool.idle_ttl = 60
+    key, client1 = ssh_pool.acquire("host", 22, "john", "secret")
+    ssh_pool.release(key, client1)
+    assert not client1.closed
+    _, client2 = ssh_pool.acquire("host", 22, "john", "secret")
+    assert client1 is client2
+
+def test_pool_loads_system_host_keys_once(ssh_pool):
+    _, client1 = ssh_pool.acquire("host1", 22, "john", "secret")
+    _, client2 = ssh_pool.acquire("host2", 22, "john", "secret")
+    assert client1._system_host_keys is client2._system_host_keys
+
+def test_pool_connect_opens_connection_outside_of_pool(ssh_pool):
+    key, shared = ssh_pool.acquire("host", 22, "john", "secret")
+    private = ssh_pool.connect("host", 22, "john", "secret")
+    assert private is not shared
+    ssh_pool.release(key, private)
+    assert private.closed
+    assert not shared.closed
+
+def test_secure_shell_opens_private_connection_when_sessions_are_exhausted(ssh_pool, monkeypatch):
+    monkeypatch.setattr(secureshell, "pool", ssh_pool)
+    shells = [SecureShell("host", "john", "secret") for _ in range(2)]
+    shared = shells[0]._client
+    assert shells[1]._client is shared
+    for _ in range(FakeTransport.max_sessions):
+        shells[0]._open_session()
+    shells[1]._open_session()
+    assert shells[1]._client is not shared
+    assert shells[0]._client is shared
+    private = shells[1]._client
+    shells[1].disconnect()
+    assert private.closed
+    assert not shared.closed
+    shells[0].disconnect()
+    assert shared.closed
@@ -0,0 +1,201 @@
+from unishell.streamreader import export_environment, ChannelReader, InteractiveChannelReader, ChannelPump
+from unishell.queue import Queue
+from socket import timeout as SocketTimeout
+from time import sleep, monotonic
+from os import pipe, write, close
+from pytest import raises
+
+
+class FakeChannel:
+
+    def __init__(self):
+        self.stdout = b""
+        self.stderr = b""
+        self.exit_status = None
+        self.eof_received = False
+        self.closed = False
+        self.sent = b""
+
+    def sendall(self, data):
+        if self.closed:
+            raise OSError("Socket is closed")
+        self.sent += data
+
+    def close(self):
+        self.closed = True
+
+    def recv_ready(self):
+        return bool(self.stdout)
+
+    def recv(self, size):
+        data, self.stdout = self.stdout[:size], self.stdout[size:]
+        return data
+
+    def recv_stderr_ready(self):
+        return bool(self.stderr)
+
+    def recv_stderr(self, size):
+        data, self.stderr = self.stderr[:size], self.stderr[size:]
+        return data
+
+    def exit_status_ready(self):
+        return self.exit_status is not None
+
+    def recv_exit_status(self):
+        return self.exit_status
+
+
+def drain(queue):
+    result = []
+    while not queue.empty():
+        result.append(queue.get())
+    return result
+
+
+def test_channel_reader_reads_output_received_after_exit_status():
+    channel = FakeChannel()
+    queue = Queue()
+    reader = ChannelReader(channel, queue)
+
+    channel.stdout = b"line1\n"
+    channel.exit_status = 0
+    assert not reader.pump()
+    assert not reader.pump()
+
+    channel.stdout = b"line2\n"
+    channel.stderr = b"error"
+    channel.eof_received = True
+    assert not reader.pump()
+    assert reader.pump()
+    assert drain(queue) == [(1, "line1"), (1, "line2"), (1, None), (2, "error"), (2, None), (0, 0), (0, None)]
+
+
+def test_channel_reader_waits_for_exit_status_after_eof():
+    channel = FakeChannel()
+    queue = Queue()
+    reader = ChannelReader(channel, queue)
+
+    channel.stdout = b"line1\n"
+    channel.eof_received = True
+    assert not reader.pump()
+    assert not reader.pump()
+
+    channel.exit_status = 3
+    assert reader.pump()
+    assert drain(queue) == [(1, "line1"), (1, None), (2, None), (0, 3), (0, None)]
+
+
+def test_interactive_reader_evaluates_quoted_command():
+    channel = FakeChannel()
+    reader = InteractiveChannelReader(channel)
+    reader.execute('echo "foo', Queue())
+    assert channel.sent.startswith(b"""(eval 'echo "foo') </dev/null;""")
+
+
+def test_interactive_reader_fails_command_on_idle_timeout():
+    channel = FakeChannel()
+    queue = Queue()
+    reader = InteractiveChannelReader(channel)
+    reader.execute("sleep 10", queue, timeout=.1)
+    assert not reader.pump()
+    sleep(.2)
+    with raises(SocketTimeout):
+        reader.pump()
+    assert channel.closed
+
+
+class BrokenChannel(FakeChannel):
+
+    def fileno(self):
+        raise OSError("no pipe")
+
+
+class PipeChannel(FakeChannel):
+
+    def __init__(self):
+        super().__init__()
+        self.pipe_r, self.pipe_w = pipe()
+        # NOTE: like paramiko after EOF, the pipe is readable for good
+        write(self.pipe_w, b"*")
+        self.pumped = 0
+
+    def fileno(self):
+        return self.pipe_r
+
+    def recv_ready(self):
+        self.pumped += 1
+        return super().recv_ready()
+
+
+def test_interactive_reader_closes_channel_when_failing():
+    channel = PipeChannel()
+    queue = Queue()
+    reader = InteractiveChannelReader(channel)
+    reader.execute("echo foo", queue)
+    channel.stdout = b"\xff\n"
+    pump = ChannelPump()
+    pump.register(reader)
+    fd, error = queue.get(timeout=1)
+    assert isinstance(error, UnicodeDecodeError)
+    assert channel.closed
+    with raises(OSError):
+        reader.execute("echo bar", Queue())
+
+
+def test_channel_pump_survives_failed_registration():
+    pump = ChannelPump()
+    queue = Queue()
+    pump.register(ChannelReader(BrokenChannel(), queue))
+    fd, error = queue.get(timeout=1)
+    assert isinstance(error, OSError)
+    assert pump.is_alive()
+
+    channel = FakeChannel()
+    channel.fileno = lambda: pipe()[0]
+    channel.eof_received = True
+    channel.exit_status = 0
+    queue = Queue()
+    pump.register(ChannelReader(channel, queue))
+    while queue.get(timeout=1) != (0, None):
+        pass
+
+
+def test_channel_pump_does_not_spin_on_eof_before_exit_status():
+    pump = ChannelPump(poll_interval=.1)
+    channel = PipeChannel()
+    channel.eof_received = True
+    queue = Queue()
+    pump.register(ChannelReader(channel, queue))
+    sleep(.5)
+    # NOTE: polled until the exit status arrives, but without spinning on the readable pipe
+    assert channel.pumped < 200
+    channel.exit_status = 0
+    while queue.get(timeout=1) != (0, None):
+        pass
+    close(channel.pipe_r)
+    close(channel.pipe_w)
+
+
+def test_channel_pump_posts_exit_status_received_after_eof_promptly():
+    pump = ChannelPump(poll_interval=10)
+    channel = PipeChannel()
+    channel.eof_received = True
+    queue = Queue()
+    pump.register(ChannelReader(channel, queue))
+    sleep(.1)
+    start = monotonic()
+    channel.exit_status = 0
+    while queue.get(timeout=1) != (0, None):
+        pass
+    assert monotonic() - start < .1
+    close(channel.pipe_r)
+    close(channel.pipe_w)
+
+
+def test_export_environment_quotes_values():
+    assert export_environment({"FOO": "it's $HOME"}) == "export FOO='it'\"'\"'s $HOME'; "
+
+
+def test_export_environment_rejects_invalid_names():
+    with raises(ValueError):
+        export_environment({"FOO=bar; rm -rf ~; X": "value"})
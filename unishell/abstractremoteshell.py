@@ -3,9 +3,12 @@ from hashlib import md5
 from os import chmod
 from time import sleep
 from binascii import hexlify, unhexlify
+from shlex import quote
 
 class AbstractRemoteShell(AbstractShell):
 
+    __slots__ = ("_target", "_connected")
+
     def __init__(self, target, *args, **kwargs):
         self._target = target
         super().__init__(*args, **kwargs)
@@ -63,10 +66,10 @@ class AbstractRemoteShell(AbstractShell):
             return result
 
         local_md5 = md5()
-        self("rm -f %s" % remote_path)
+        self("rm -f %s" % quote(remote_path))
         for chunk in read_by_chunk(local_path):
             local_md5.update(chunk)
-            self("echo -n -e %s >> %s\n" % (backslash_xify(chunk), remote_path))
+            self("echo -n -e %s >> %s\n" % (backslash_xify(chunk), quote(remote_path)))
         local_md5 = local_md5.hexdigest()
         remote_md5 = self.md5(remote_path)
         if remote_md5 and remote_md5 != local_md5:
@@ -1,30 +1,138 @@
 from .shellerror import ShellError
-from uuid import uuid4
-from logging import getLogger, StreamHandler, Formatter, INFO, DEBUG, ERROR, CRITICAL
+from .shellresult import ShellResult
+from .queue import Queue
+from .streamreader import export_environment
+from secrets import token_hex
+from logging import getLogger, StreamHandler, Formatter, INFO, DEBUG, ERROR, CRITICAL, NOTSET
 from sys import stdout, stderr
-from termcolor import colored
-from os import chmod, stat
+from os import chmod, stat, environ
+from shlex import quote
+from string import Template
+from collections import ChainMap
+from collections.abc import Mapping, MutableMapping
 
+# NOTE: command alternatives that are probed together with the OS in a single round-trip
+PROBED_COMMANDS = (("md5sum", "md5"), ("hexdump", "od"), ("chmod",))
+# NOTE: OS specific invocation of the detected commands
+COMMAND_FLAVOURS = {
+    'darwin': {
+        "md5": "md5 -q",
+    },
+}
+# NOTE: templates are substituted with the already quoted path
+STAT_COMMAND_TEMPLATES = {
+    'linux': Template("stat -c '%a' $path"),
+    'darwin': Template("stat -f '%A' $path"),
+}
+HEXDUMP_COMMAND_TEMPLATES = {
+    "hexdump": Template("hexdump -C $path | cut -c 10-60"),
+    "od": Template("od -t x1 -An $path"),
+}
+PERMISSIONS_CACHE_SIZE = 1024
+ANSI_CODES = {
+    "bold": "1",
+    "red": "31",
+    "green": "32",
+    "yellow": "33",
+    "magenta": "35",
+    "cyan": "36",
+}
+ANSI_RESET = "\033[0m"
 
-class AbstractShell(dict):
+
+def ansi_colored(text, color=None, attrs=("bold",)):
+    codes = [ANSI_CODES[attr] for attr in attrs] + ([ANSI_CODES[color]] if color else [])
+    return "\033[%sm%s%s" % (";".join(codes), text, ANSI_RESET) if codes else text
+
+
+def can_colorize(stream):
+    if environ.get("NO_COLOR") or environ.get("ANSI_COLORS_DISABLED"):
+        return False
+    if environ.get("FORCE_COLOR"):
+        return True
+    isatty = getattr(stream, "isatty", None)
+    return bool(isatty and isatty())
+
+
+# NOTE: logger kind -> (stream, colored format, plain format), formats are computed once
+LOGGER_SPECS = {
+    "in": (stdout, ansi_colored("$ ") + ansi_colored("%(message)s", "cyan"), "$ %(message)s"),
+    "out": (stdout, "%(message)s", "%(message)s"),
+    "err": (stderr, ansi_colored("%(message)s", "red"), "%(message)s"),
+    "oob": (stdout, ansi_colored("> ") + ansi_colored("%(message)s", "yellow"), "> %(message)s"),
+    "spy.read": (stdout, ansi_colored("<<< ") + ansi_colored("%(message)s", "magenta"), "<<< %(message)s"),
+    "spy.write": (stdout, ansi_colored(">>> ") + ansi_colored("%(message)s", "green"), ">>> %(message)s"),
+}
+
+
+class AbstractShell(MutableMapping):
+
+    # NOTE: the environment lives in its own dict, the shell configuration in slots
+    __slots__ = ("_env", "_env_version", "_env_prefix_cache", "_check_xc", "_check_err", "_wait", "_id",
+                 "_loggers", "_log_muted", "_log_level", "_available_commands", "_os_type", "_probed_commands",
+                 "_stat_cmd_template", "_permissions_cache", "_result")
+
+    # NOTE: set by subclasses whose do_pull/do_push already carry the permission bits
+    _transfer_preserves_permissions = False
 
     # TODO: allow to pass logger or log handlers from outside
     def __init__(self, check_xc: bool = False, check_err: bool = False, wait: bool = True, log_level: int = CRITICAL, **kwargs):
-        dict.__init__(self, kwargs)
-        self._local_env = {}
+        self._env = dict(kwargs)
+        self._env_version = 0
+        self._env_prefix_cache = (-1, "")
         self._check_xc = check_xc
         self._check_err = check_err
         self._wait = wait
-        self._id = uuid4().hex[:16].upper()
-        self._in_logger = self._build_logger("%s.in" % str(self), stdout, prefix="$ ", color="cyan")
-        self._out_logger = self._build_logger("%s.out" % str(self), stdout, attrs=[])
-        self._err_logger = self._build_logger("%s.err" % str(self), stderr, color="red")
-        self._oob_logger = self._build_logger("%s.oob" % str(self), stdout, prefix="> ", color="yellow")
-        self._spy_read_logger = self._build_logger("%s.spy.read" % str(self), stdout, prefix="<<< ", color="magenta")
-        self._spy_write_logger = self._build_logger("%s.spy.write" % str(self), stdout, prefix=">>> ", color="green")
-        self.set_log_level(log_level)
+        self._id = token_hex(8).upper()
+        self._loggers = {}  # Built lazily on first use
+        self._log_muted = False
+        self._log_level = log_level
         self._available_commands = {}
         self._os_type = None  # Detected lazily on first use
+        self._probed_commands = None
+        self._stat_cmd_template = None
+        self._permissions_cache = {}
+
+    def __getitem__(self, key):
+        return self._env[key]
+
+    # NOTE: every mutation of the environment bumps its version, see env_prefix()
+    def __setitem__(self, key, value):
+        self._env[key] = value
+        self._env_version += 1
+
+    def __delitem__(self, key):
+        del self._env[key]
+        self._env_version += 1
+
+    def __iter__(self):
+        return iter(self._env)
+
+    def __len__(self):
+        return len(self._env)
+
+    def __contains__(self, key):
+        return key in self._env
+
+    def get(self, key, default=None):
+        return self._env.get(key, default)
+
+    def update(self, *args, **kwargs):
+        self._env.update(*args, **kwargs)
+        self._env_version += 1
+
+    def env_prefix(self, env):
+        """
+        Shell prefix exporting the given environment. The prefix of the shell
+        environment itself (no per-call overrides) is cached until it changes.
+        """
+        if env is not self._env:
+            return export_environment(env)
+        version, prefix = self._env_prefix_cache
+        if version != self._env_version:
+            prefix = export_environment(self._env)
+            self._env_prefix_cache = (self._env_version, prefix)
+        return prefix
 
     def id(self):
         return self._id
@@ -38,60 +146,128 @@ class AbstractShell(dict):
         check_err = check_err if check_err is not None else self._check_err
         wait = wait if wait is not None else self._wait
 
-        env = dict(self)
-        env.update(kwargs)
+        # NOTE: arbitrary commands may change permissions behind our back
+        self._permissions_cache.clear()
+        env = ChainMap(kwargs, self._env) if kwargs else self._env
         self._result = self.execute_command(command=cmd, env=env, wait=wait, check_err=check_err, cwd=cwd, timeout=timeout)
 
-        if check_xc and self._result.exit_code() != 0:
-            raise ShellError(cmd, "exit code '%s'" % str(self._result.exit_code()))
+        # NOTE: only wait for the exit code when it needs to be checked
+        if check_xc:
+            exit_code = self._result.exit_code()
+            if exit_code != 0:
+                raise ShellError(cmd, "exit code '%s'" % exit_code)
         return self._result
 
     def wait(self):
         self._result.wait()
 
-    def execute_command(self, command: str, env: dict = {}, wait: bool = True, check_err: bool = False, cwd: str | None = None, timeout: float | None = None):
+    def batch(self, commands: list[str], check_xc: bool | None = None, check_err: bool | None = None, cwd: str | None = None, timeout: float | None = None, **kwargs) -> list[ShellResult]:
+        """
+        Execute several independent commands in a single shell invocation.
+        Each command runs in its own subshell, its output is delimited by tags
+        and split back locally into one ShellResult per command.
+        """
+        check_xc = check_xc if check_xc is not None else self._check_xc
+        check_err = check_err if check_err is not None else self._check_err
+
+        self._permissions_cache.clear()
+        env = ChainMap(kwargs, self._env) if kwargs else self._env
+        tag = token_hex(16).upper()
+        script = "\n".join("(%s\n); printf '%s:%d:%%d\\n' $?; printf '%s:%d\\n' >&2" % (command, tag, index, tag, index)
+                           for index, command in enumerate(commands))
+        # NOTE: the tagged script is not logged, each command is logged along with its own result
+        self._log_muted = True
+        try:
+            result = self.execute_command(command=script, env=env, cwd=cwd, timeout=timeout)
+            combined = result.combined()
+        finally:
+            self._log_muted = False
+        self._result = result
+
+        queues = [Queue() for _ in commands]
+        exit_codes = [None for _ in commands]
+        current = {1: 0, 2: 0}
+        for fd, line in combined:
+            index = current[fd]
+            if index >= len(commands):
+                continue
+            head, found, tail = line.partition(tag)
+            if head or not found:
+                queues[index].put( (fd, head) )
+            if found:
+                if fd == 1:
+                    exit_codes[index] = int(tail.split(":")[2])
+                current[fd] += 1
+
+        results = []
+        for command, queue, exit_code in zip(commands, queues, exit_codes):
+            queue.put( (0, exit_code if exit_code is not None else result.exit_code()) )
+            queue.put( (1, None) )
+            queue.put( (2, None) )
+            queue.put( (0, None) )
+            results.append(ShellResult(self, command, queue, True, False))
+
+        for command, result in zip(commands, results):
+            if check_err and result.stderr():
+                raise ShellError(command, "stderr '%s'" % result.stderr()[-1])
+            if check_xc and result.exit_code() != 0:
+                raise ShellError(command, "exit code '%s'" % result.exit_code())
+        return results
+
+    def execute_command(self, command: str, env: Mapping[str, str] = {}, wait: bool = True, check_err: bool = False, cwd: str | None = None, timeout: float | None = None):
         raise NotImplementedError("this method must be implemented by the subclass")
 
     @staticmethod
-    def _build_logger(name, stream, prefix="", color=None, attrs=["bold"]):
-        logger = getLogger(name)
-        logger.setLevel(CRITICAL)
+    def _build_logger(logger, stream, colored_format, plain_format):
         handler = StreamHandler(stream)
-        formatter = Formatter(colored(prefix, attrs=attrs) + colored('%(message)s', color=color, attrs=attrs))
+        formatter = Formatter(colored_format if can_colorize(stream) else plain_format)
         handler.setFormatter(formatter)
         logger.addHandler(handler)
         return logger
 
+    def _logger_name(self, kind):
+        return "%s.%s" % (str(self), kind)
+
+    def _logger(self, kind):
+        logger = self._loggers.get(kind)
+        if logger is None:
+            logger = getLogger(self._logger_name(kind))
+            # NOTE: the level may have been configured through logging since the shell was constructed
+            if logger.level == NOTSET:
+                logger.setLevel(self._log_level)
+            self._loggers[kind] = self._build_logger(logger, *LOGGER_SPECS[kind])
+        return logger
+
     def set_log_level(self, level):
         self._log_level = level
-        self._in_logger.setLevel(level)
-        self._out_logger.setLevel(level)
-        self._err_logger.setLevel(level)
-        self._oob_logger.setLevel(level)
-        self._spy_read_logger.setLevel(level)
-        self._spy_write_logger.setLevel(level)
+        for kind in LOGGER_SPECS:
+            getLogger(self._logger_name(kind)).setLevel(level)
 
     def log_stdin(self, text):
-        self._in_logger.info(text)
+        if not self._log_muted:
+            self._logger("in").info(text)
 
     def log_stdout(self, text):
-        self._out_logger.info(text)
+        if not self._log_muted:
+            self._logger("out").info(text)
 
     def log_stderr(self, text):
-        self._err_logger.error(text)
+        if not self._log_muted:
+            self._logger("err").error(text)
 
     def log_oob(self, text):
-        self._oob_logger.info(text)
+        self._logger("oob").info(text)
 
     def log_spy_read(self, text):
-        self._spy_read_logger.debug(repr(text))
+        self._logger("spy.read").debug(repr(text))
 
     def log_spy_write(self, text):
-        self._spy_write_logger.debug(repr(text))
+        self._logger("spy.write").debug(repr(text))
 
     def detect_command(self, *alternatives, **kwargs):
-        for alternative in alternatives:
-            if self.execute_command("command -v %s" % alternative):
+        results = self.batch(["command -v %s" % quote(alternative) for alternative in alternatives], check_xc=False, check_err=False)
+        for alternative, result in zip(alternatives, results):
+            if result:
                 return alternative
         if kwargs.get("mandatory", True):
             raise RuntimeError("could find command '%s', tried any of the the following: %s" % (alternatives[0], alternatives))
@@ -100,37 +276,51 @@ class AbstractShell(dict):
     def get_command(self, *alternatives, **kwargs):
         command = alternatives[0]
         if command not in self._available_commands:
-            detected = self.detect_command(*alternatives, **kwargs)
+            self._probe()
+            if all(alternative in self._probed_commands for alternative in alternatives):
+                detected = next((alternative for alternative in alternatives if self._probed_commands[alternative]), None)
+                if detected is None and kwargs.get("mandatory", True):
+                    raise RuntimeError("could find command '%s', tried any of the the following: %s" % (command, alternatives))
+            else:
+                detected = self.detect_command(*alternatives, **kwargs)
+            if detected is not None:
+                detected = COMMAND_FLAVOURS.get(self._os_type, {}).get(detected, detected)
             self._available_commands[command] = detected
             return detected
         return self._available_commands[command]
 
     def md5(self, path, mandatory=False):
         command = self.get_command("md5sum", "md5", mandatory=mandatory)
-        result = self.execute_command("%s '%s'" % (command, path))
+        result = self.execute_command("%s %s" % (command, quote(path)))
         return str(result).split()[0].strip() if result else None
 
     def hexdump(self, path, mandatory=True):
         command = self.get_command("hexdump", "od", mandatory=mandatory)
-        if command == "hexdump":
-            result = self.execute_command("hexdump -C %s | cut -c 10-60" % path)
-        elif command == "od":
-            result = self.execute_command("od -t x1 -An %s" % path)
+        result = self.execute_command(HEXDUMP_COMMAND_TEMPLATES[command].substitute(path=quote(path)))
         return str(result).replace(" ", "").rstrip("\r\n")
         
-    def _detect_os(self):
+    def _probe(self):
         """
-        Detect the operating system running on the shell.
-        Returns 'linux', 'darwin' (macOS), or 'unknown'.
-        Result is cached after first detection.
+        Detect the operating system and the availability of the commands in
+        PROBED_COMMANDS using a single batched invocation.
+        Result is cached after first probe.
         """
-        if self._os_type is not None:
-            return self._os_type
-        
+        if self._probed_commands is not None:
+            return
+
+        alternatives = [alternative for group in PROBED_COMMANDS for alternative in group]
+        self._probed_commands = {}
         try:
-            result = self.execute_command("uname -s")
-            if result and result.exit_code() == 0:
-                os_name = str(result).strip().lower()
+            results = self.batch(["uname -s"] + ["command -v %s" % quote(alternative) for alternative in alternatives],
+                                 check_xc=False, check_err=False)
+        except Exception:
+            self._os_type = self._os_type or 'unknown'
+            self._stat_cmd_template = STAT_COMMAND_TEMPLATES.get(self._os_type)
+            return
+
+        if self._os_type is None:
+            if results[0] and results[0].exit_code() == 0:
+                os_name = str(results[0]).strip().lower()
                 if 'linux' in os_name:
                     self._os_type = 'linux'
                 elif 'darwin' in os_name:
@@ -139,9 +329,19 @@ class AbstractShell(dict):
                     self._os_type = 'unknown'
             else:
                 self._os_type = 'unknown'
-        except Exception:
-            self._os_type = 'unknown'
-        
+        self._stat_cmd_template = STAT_COMMAND_TEMPLATES.get(self._os_type)
+
+        for alternative, result in zip(alternatives, results[1:]):
+            self._probed_commands[alternative] = bool(result)
+
+    def _detect_os(self):
+        """
+        Detect the operating system running on the shell.
+        Returns 'linux', 'darwin' (macOS), or 'unknown'.
+        Result is cached after first detection.
+        """
+        if self._os_type is None:
+            self._probe()
         return self._os_type
 
     def get_permissions(self, path):
@@ -151,28 +351,33 @@ class AbstractShell(dict):
         Returns:
             int: Permission bits (e.g., 0o755)
         """
-        os_type = self._detect_os()
-        
-        if os_type == 'linux':
-            stat_cmd = f"stat -c '%%a' '{path}'"
-        elif os_type == 'darwin':
-            stat_cmd = f"stat -f '%%A' '{path}'"
-        else:
+        if path in self._permissions_cache:
+            return self._permissions_cache[path]
+
+        self._detect_os()
+        if self._stat_cmd_template is None:
             raise RuntimeError("Unsupported OS type for permission detection")
         
         try:
             # TODO: raise exception if stat command fails (e.g., file does not exist)
-            result = self.execute_command(stat_cmd)
+            result = self.execute_command(self._stat_cmd_template.substitute(path=quote(path)))
             if result and result.exit_code() == 0:
                 output = str(result).strip()
                 if output.isdigit():
-                    return int(output, 8)
+                    return self._cache_permissions(path, int(output, 8))
         except Exception as e:
             raise RuntimeError(f"Failed to get permissions for '{path}': {str(e)}")
 
+    def _cache_permissions(self, path, permissions):
+        if len(self._permissions_cache) >= PERMISSIONS_CACHE_SIZE:
+            del self._permissions_cache[next(iter(self._permissions_cache))]
+        self._permissions_cache[path] = permissions
+        return permissions
+
     def set_permissions(self, path, permissions):
         chmod = self.get_command("chmod", mandatory=True)
-        self("%s %o '%s'" % (chmod, permissions, path))
+        if self("%s %o %s" % (chmod, permissions, quote(path))):
+            self._cache_permissions(path, permissions)
 
     def do_pull(self, local_path, remote_path):
         raise NotImplementedError("this method must be implemented by the subclass")
@@ -183,11 +388,16 @@ class AbstractShell(dict):
     def pull(self, local_path, remote_path):
         self.log_oob("'%s' <- '%s'" % (local_path, remote_path))
         self.do_pull(local_path, remote_path)
-        chmod(local_path, self.get_permissions(remote_path))
+        if not self._transfer_preserves_permissions:
+            chmod(local_path, self.get_permissions(remote_path))
 
     def push(self, local_path, remote_path):
         self.log_oob("'%s' -> '%s'" % (local_path, remote_path))
         self.do_push(local_path, remote_path)
-        self.set_permissions(remote_path, (stat(local_path).st_mode & 0o777))
+        if self._transfer_preserves_permissions:
+            # NOTE: remote_path may be a directory the file was copied into, its permissions are unknown
+            self._permissions_cache.pop(remote_path, None)
+        else:
+            self.set_permissions(remote_path, stat(local_path).st_mode & 0o777)
 
 
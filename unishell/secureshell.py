@@ -4,16 +4,18 @@ if sys.version_info.major == 2:
     from warnings import filterwarnings
     filterwarnings("ignore", module=".*paramiko.*")
 
-from paramiko import SSHClient, AutoAddPolicy
 from .abstractshell import AbstractShell
 from .abstractremoteshell import AbstractRemoteShell
 from .shellresult import ShellResult
 from .queue import Queue
-from .streamreader import StandardStreamReader
-from threading import Thread
+from .streamreader import ChannelPump, ChannelReader, InteractiveChannelReader, BUFFER_SIZE, change_directory
+from .sshpool import pool
 from scp import SCPClient
+from paramiko import ChannelException
+from threading import Lock
 from time import sleep
 from logging import CRITICAL
+from collections.abc import Mapping
 
 
 class SecureShellException(BaseException):
@@ -22,62 +24,118 @@ class SecureShellException(BaseException):
 
 class SecureShell(AbstractRemoteShell):
 
+    __slots__ = ("_hostname", "_port", "_username", "_password", "_interactive", "_pool_key", "_client",
+                 "_overflow_clients", "_scp_client", "_interactive_reader")
+
+    _transfer_preserves_permissions = True
+
+    # NOTE: a single pump thread reads the channels of all the shells
+    _pump = None
+    _pump_lock = Lock()
+
     def __init__(self, hostname, username, password=None, port=22,
-                 check_xc=False, check_err=False, wait=True, log_level=CRITICAL, **kwargs):
+                 check_xc=False, check_err=False, wait=True, log_level=CRITICAL, interactive=False, **kwargs):
         super(SecureShell, self).__init__(hostname, check_xc=check_xc, check_err=check_err, 
                                           wait=wait, log_level=log_level, **kwargs)
         self._hostname = hostname
         self._port = port
         self._username = username
         self._password = password
+        self._interactive = interactive
         self.connect()
 
+    @classmethod
+    def pump(cls):
+        with cls._pump_lock:
+            if cls._pump is None or not cls._pump.is_alive():
+                cls._pump = ChannelPump()
+            return cls._pump
+
     def do_connect(self, timeout: float | None = None):
-        self._client = SSHClient()
-        self._client.load_system_host_keys()
-        self._client.set_missing_host_key_policy(AutoAddPolicy())
-        self._client.connect(hostname=self._hostname, port=self._port, username=self._username, password=self._password, timeout=timeout)
-        self._scp_client = SCPClient(self._client.get_transport())
+        self._pool_key, self._client = pool.acquire(self._hostname, self._port, self._username, self._password, timeout=timeout)
+        self._overflow_clients = []
+        self._scp_client = self._new_scp_client()
+        if self._interactive:
+            # NOTE: no pty is requested, so there is no echo nor prompt to deal with
+            #       and stderr is kept separated from stdout
+            channel = self._open_session()
+            channel.invoke_shell()
+            self._interactive_reader = InteractiveChannelReader(channel)
+            self.pump().register(self._interactive_reader)
+            self._interactive_reader.sync()
 
     def do_disconnect(self):
-        self._client.close()
+        if self._interactive:
+            self._interactive_reader.close()
+        for client in self._overflow_clients + [self._client]:
+            pool.release(self._pool_key, client)
+        self._overflow_clients = []
+
+    def _new_scp_client(self):
+        scp_client = SCPClient(self._client.get_transport(), buff_size=BUFFER_SIZE)
+        # NOTE: scp receives the mode with each file, '-p' makes the remote side apply it as is
+        #       (ignoring umask and existing files), the local side always applies it on get
+        scp_client.scp_command += b" -p"
+        return scp_client
+
+    def _use_private_connection(self):
+        # NOTE: the server refuses more sessions on the current connection (MaxSessions), the shell moves
+        #       to a connection of its own; the previous one may still run commands, it is released on disconnect
+        self.log_oob("too many sessions on the connection to '%s', opening a new one..." % self._target)
+        self._overflow_clients.append(self._client)
+        self._client = pool.connect(self._hostname, self._port, self._username, self._password)
+        self._scp_client = self._new_scp_client()
+
+    def _open_session(self):
+        transport = self._client.get_transport()
+        if transport is None:
+            raise SecureShellException("Could not get transport from SSH client.")
+        try:
+            return transport.open_session()
+        except ChannelException:
+            self._use_private_connection()
+            return self._client.get_transport().open_session()
 
-    def execute_command(self, command: str, env: dict = {}, wait: bool = True,
+    def execute_command(self, command: str, env: Mapping[str, str] = {}, wait: bool = True,
                         check_err: bool = False, cwd=None, 
                         timeout: float | None = None):
-        for var, val in env.items():
-            command = f"{var}={val}; {command}"
-
-        transport = self._client.get_transport()
-        if transport is not None:
-            chan = transport.open_session()
-            chan.settimeout(timeout=timeout)
-        else:
-            raise SecureShellException("Could not get transport from SSH client.")
+        command = self.env_prefix(env) + command
 
-        try:
-            chan.exec_command( ((f"cd \"{cwd}\"; ") if cwd else "") + command)
+        if self._interactive:
             queue = Queue()
-            StandardStreamReader(chan.makefile("r"), 1, queue)
-            StandardStreamReader(chan.makefile_stderr("r"), 2, queue)
+            self._interactive_reader.execute(change_directory(cwd) + command, queue, timeout=timeout)
+            return ShellResult(self, command, queue, wait, check_err)
 
-            def post_process_exit_code():
-                queue.put( (0, chan.recv_exit_status()) )
-                queue.put( (0, None) )
-            Thread(target=post_process_exit_code).start()
+        chan = self._open_session()
+        chan.settimeout(timeout=timeout)
 
+        try:
+            chan.exec_command( change_directory(cwd) + command)
+            queue = Queue()
+            self.pump().register(ChannelReader(chan, queue, timeout=timeout))
             return ShellResult(self, command, queue, wait, check_err)
 
         except socket.timeout:
             raise SecureShellException("Command execution timed out.")
 
     def do_pull(self, local_path, remote_path):
-        self._scp_client.get(remote_path, local_path)
+        try:
+            self._scp_client.get(remote_path, local_path, preserve_times=True)
+        except ChannelException:
+            self._use_private_connection()
+            self._scp_client.get(remote_path, local_path, preserve_times=True)
 
     def do_push(self, local_path, remote_path):
-        self._scp_client.put(local_path, remote_path)
+        try:
+            self._scp_client.put(local_path, remote_path, preserve_times=True)
+        except ChannelException:
+            self._use_private_connection()
+            self._scp_client.put(local_path, remote_path, preserve_times=True)
 
     def do_reboot(self):
         self("reboot > /dev/null 2>&1 &")
         sleep(.3)
+        # NOTE: the connection is about to die, make sure nobody picks it up from the pool
+        for client in self._overflow_clients + [self._client]:
+            pool.discard(self._pool_key, client)
 
@@ -11,6 +11,8 @@ from logging import CRITICAL
 
 class SerialShell(AbstractRemoteShell):
 
+    __slots__ = ("_prompt", "_port", "_baudrate", "_bytesize", "_parity", "_username", "_password", "_serial")
+
     def __init__(self, port: str, baudrate: int = 115200, bytesize: int = EIGHTBITS, parity: int = PARITY_NONE, username: str | None = None, password: str | None = None, 
                  check_xc: bool = False, check_err: bool = False, wait: bool = True, log_level: int = CRITICAL, **kwargs):
         super().__init__(port, check_xc=check_xc, check_err=check_err, 
@@ -96,13 +98,13 @@ class SerialShell(AbstractRemoteShell):
             return None
         return line
 
-    def execute_command(self, command, env={}, wait=True, check_err=False, cwd=None):
+    def execute_command(self, command, env={}, wait=True, check_err=False, cwd=None, timeout=None):
         # NOTE(cme): need to re-export the prompt because the serial line might be shared
         #            bewteen several instance of SerialShell to the same tty
         self._write("export PS1='\n%s'\n" % self._prompt)
         self._read_until(self._prompt)
         self._read_until(self._prompt)
-        self._write(PrefixedStreamReader.wrap_command(command, env, cwd))
+        self._write(PrefixedStreamReader.wrap_command(command, self.env_prefix(env), cwd))
         sleep(.1)
         self._read_available()
         self._write("\n")
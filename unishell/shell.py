@@ -2,11 +2,38 @@ from .parseduri import ParsedUri
 from .localshell import LocalShell
 from .secureshell import SecureShell
 from .serialshell import SerialShell
+from functools import lru_cache
+from uritools import urisplit
 from logging import CRITICAL
 
+# NOTE: keyword arguments which may be provided in place of parts of the uri
+URI_ARGUMENTS = ("username", "password", "port")
+
+
+@lru_cache(maxsize=256)
+def _parse_uri_cached(uri, kwargs_items):
+    return ParsedUri(uri, **dict(kwargs_items))
+
+
+def _parse_uri(uri, kwargs):
+    # NOTE: passwords must not be kept around in the cache
+    if "password" in kwargs or (uri and ":" in (urisplit(uri).getuserinfo() or "")):
+        return ParsedUri(uri, **kwargs)
+    kwargs_items = tuple(sorted(kwargs.items()))
+    try:
+        hash(kwargs_items)
+    except TypeError:
+        # NOTE: unhashable kwargs, cannot be cached
+        return ParsedUri(uri, **kwargs)
+    return _parse_uri_cached(uri, kwargs_items)
+
+
 def Shell(uri: ParsedUri | None = None, check_xc: bool = False, check_err: bool = False, wait: bool = True, log_level: int = CRITICAL, **kwargs):
-    parsed_uri = ParsedUri(uri, check_xc=check_xc, check_err=check_err, wait=wait, 
-                           log_level=log_level, **kwargs)
+    # NOTE: ParsedUri would also drop these from the environment of a local shell
+    if uri is None and not any(argname in kwargs for argname in URI_ARGUMENTS):
+        return LocalShell(check_xc=check_xc, check_err=check_err, wait=wait, log_level=log_level, **kwargs)
+    kwargs.update(check_xc=check_xc, check_err=check_err, wait=wait, log_level=log_level)
+    parsed_uri = _parse_uri(uri, kwargs)
     if parsed_uri.scheme == "local":
         return LocalShell(**parsed_uri.kwargs)
     elif parsed_uri.scheme == "ssh":
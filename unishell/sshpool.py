@@ -0,0 +1,126 @@
+from paramiko import SSHClient, AutoAddPolicy, HostKeys
+from hashlib import sha256
+from os.path import expanduser
+from threading import Lock, Thread
+from time import monotonic, sleep
+
+
+class PooledConnection:
+
+    def __init__(self, client):
+        self.client = client
+        self.refcount = 1
+        self.released_at = None
+
+    def is_active(self):
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+
+class SSHConnectionPool:
+    """
+    Share live SSH connections between shells targeting the same host with
+    the same credentials. Connections are refcounted and only closed once
+    they have been idle for `idle_ttl` seconds.
+    """
+
+    def __init__(self, idle_ttl: float = 30.0):
+        self.idle_ttl = idle_ttl
+        self._lock = Lock()
+        self._connections = {}
+        self._reaper = None
+        self._system_host_keys = None
+
+    @staticmethod
+    def key(hostname, port, username, password=None):
+        digest = sha256(password.encode("utf-8")).hexdigest() if password is not None else None
+        return (hostname, port, username, digest)
+
+    def acquire(self, hostname, port, username, password=None, timeout: float | None = None):
+        key = self.key(hostname, port, username, password)
+        with self._lock:
+            connection = self._connections.get(key)
+            if connection is not None and connection.is_active():
+                connection.refcount += 1
+                connection.released_at = None
+                return key, connection.client
+
+        client = self.connect(hostname, port, username, password, timeout=timeout)
+
+        with self._lock:
+            connection = self._connections.get(key)
+            if connection is not None and connection.is_active():
+                # NOTE: another thread connected in the meantime, keep theirs
+                connection.refcount += 1
+                connection.released_at = None
+                client.close()
+                return key, connection.client
+            if connection is not None and connection.refcount == 0:
+                connection.client.close()
+            self._connections[key] = PooledConnection(client)
+        return key, client
+
+    def connect(self, hostname, port, username, password=None, timeout: float | None = None):
+        """
+        Open a connection which is not shared through the pool. It is closed
+        when released.
+        """
+        client = SSHClient()
+        # NOTE: same as client.load_system_host_keys(), without parsing known_hosts for each connection
+        client._system_host_keys = self.system_host_keys()
+        client.set_missing_host_key_policy(AutoAddPolicy())
+        client.connect(hostname=hostname, port=port, username=username, password=password, timeout=timeout)
+        return client
+
+    def system_host_keys(self):
+        with self._lock:
+            if self._system_host_keys is None:
+                host_keys = HostKeys()
+                try:
+                    host_keys.load(expanduser("~/.ssh/known_hosts"))
+                except IOError:
+                    pass
+                self._system_host_keys = host_keys
+            return self._system_host_keys
+
+    def release(self, key, client):
+        with self._lock:
+            connection = self._connections.get(key)
+            if connection is None or connection.client is not client:
+                # NOTE: client was superseded by a fresh connection, nobody else can get it anymore
+                client.close()
+                return
+            connection.refcount -= 1
+            if connection.refcount > 0:
+                return
+            if self.idle_ttl <= 0:
+                del self._connections[key]
+                client.close()
+                return
+            connection.released_at = monotonic()
+            if self._reaper is None:
+                self._reaper = Thread(target=self._reap, daemon=True)
+                self._reaper.start()
+
+    def discard(self, key, client):
+        with self._lock:
+            connection = self._connections.get(key)
+            if connection is not None and connection.client is client:
+                del self._connections[key]
+        client.close()
+
+    def _reap(self):
+        while True:
+            sleep(self.idle_ttl)
+            with self._lock:
+                now = monotonic()
+                for key, connection in list(self._connections.items()):
+                    if connection.refcount == 0 and now - connection.released_at >= self.idle_ttl:
+                        del self._connections[key]
+                        connection.client.close()
+                if not any(connection.refcount == 0 for connection in self._connections.values()):
+                    self._reaper = None
+                    return
+
+
+pool = SSHConnectionPool()
@@ -1,14 +1,43 @@
-from threading import Thread
+from threading import Thread, Lock
 from .queue import Queue
-from time import sleep
+from secrets import token_hex
+from time import sleep, monotonic
+from selectors import DefaultSelector, EVENT_READ
+from os import pipe, read, write
+from socket import timeout as SocketTimeout
+from shlex import quote
+import re
+
+BUFFER_SIZE = 65536
+_VARIABLE_NAME_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*\Z")
+# NOTE: end of output sentinels of the interactive shell, matched against each complete line
+_SENTINEL_RES = {
+    1: re.compile(rb"__XC__(?P<exit_code>\d+)__EOF__(?P<nonce>[0-9a-f]{16})$"),
+    2: re.compile(rb"__ERR__EOF__(?P<nonce>[0-9a-f]{16})$"),
+}
+
+
+def export_environment(environment):
+    if not environment:
+        return ""
+    for var in environment:
+        if not _VARIABLE_NAME_RE.match(var):
+            raise ValueError("invalid environment variable name '%s'" % var)
+    return "export %s; " % " ".join("%s=%s" % (var, quote(str(val))) for var, val in environment.items())
+
+
+def change_directory(cwd):
+    return "cd %s; " % quote(cwd) if cwd else ""
+
 
 class StandardStreamReader(Thread):
 
-    def __init__(self, input_stream, input_fd, output_queue):
+    def __init__(self, input_stream, input_fd, output_queue, process=None):
         super(StandardStreamReader, self).__init__()
         self.input_stream = input_stream
         self.input_fd = input_fd
         self.output_queue = output_queue
+        self.process = process
         self.start()
 
     def run(self):
@@ -23,17 +52,260 @@ class StandardStreamReader(Thread):
             self.output_queue.put( (self.input_fd, None) )
         except Exception as e:         
             self.output_queue.put( (self.input_fd, e) )
+        # NOTE: the exit code is posted by one of the readers, once its stream is exhausted
+        if self.process is not None:
+            self.output_queue.put( (0, self.process.wait()) )
+            self.output_queue.put( (0, None) )
+
+
+class ChannelReader:
+    """
+    Split the stdout and stderr of a paramiko exec channel into lines, in
+    large chunks, and post the exit code once the command is finished.
+    Driven by a ChannelPump.
+    """
+
+    def __init__(self, channel, output_queue, timeout=None, chunk_size=BUFFER_SIZE):
+        self.channel = channel
+        self.output_queue = output_queue
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self._pending = { 1: b'', 2: b'' }
+        self._last_activity = monotonic()
+        self.fd = None
+
+    def _feed(self, fd, data):
+        lines = (self._pending[fd] + data).split(b"\n")
+        self._pending[fd] = lines.pop()
+        for line in lines:
+            self.output_queue.put( (fd, line.decode('utf-8').rstrip("\n\r")) )
+
+    def _flush(self, fd):
+        if self._pending[fd]:
+            self.output_queue.put( (fd, self._pending[fd].decode('utf-8').rstrip("\n\r")) )
+            self._pending[fd] = b''
+        self.output_queue.put( (fd, None) )
+
+    def pump(self):
+        """
+        Read whatever is available on the channel.
+        Returns True once the command is finished.
+        """
+        # NOTE: the exit status may be received before the last of the output, the command is
+        #       only finished once EOF was seen (before checking for data) and nothing is left
+        eof = self.channel.eof_received or self.channel.closed
+        active = False
+        if self.channel.recv_ready():
+            self._feed(1, self.channel.recv(self.chunk_size))
+            active = True
+        if self.channel.recv_stderr_ready():
+            self._feed(2, self.channel.recv_stderr(self.chunk_size))
+            active = True
+        if active:
+            self._last_activity = monotonic()
+        elif eof and (self.channel.exit_status_ready() or self.channel.closed):
+            self._flush(1)
+            self._flush(2)
+            self.output_queue.put( (0, self.channel.recv_exit_status()) )
+            self.output_queue.put( (0, None) )
+            return True
+        elif self.timeout is not None and monotonic() - self._last_activity > self.timeout:
+            raise SocketTimeout("Command execution timed out.")
+        return False
+
+    def fail(self, error):
+        self.output_queue.put( (1, error) )
+
+
+class InteractiveChannelReader:
+    """
+    Execute commands one at a time on a persistent shell channel. Each
+    command is followed by sentinels carrying a nonce (and, on stdout, the
+    exit code) which delimit its output in the shared streams.
+    Driven by a ChannelPump.
+    """
+
+    def __init__(self, channel, chunk_size=BUFFER_SIZE):
+        self.channel = channel
+        self.chunk_size = chunk_size
+        self._idle = Lock()
+        self._current = None
+        self._pending = { 1: b'', 2: b'' }
+        self.fd = None
+
+    def execute(self, command, output_queue, timeout=None):
+        self._idle.acquire()
+        nonce = token_hex(8)
+        self._current = { "queue": output_queue, "nonce": nonce.encode("utf-8"), "left": {1, 2},
+                          "timeout": timeout, "last_activity": monotonic() }
+        try:
+            # NOTE: the command is eval'ed so that syntax errors stay within the subshell
+            self.channel.sendall(("(eval %s) </dev/null; printf '__XC__%%d__EOF__%s\\n' $?; printf '__ERR__EOF__%s\\n' >&2\n"
+                                  % (quote(command), nonce, nonce)).encode("utf-8"))
+        except Exception:
+            self._current = None
+            self._idle.release()
+            raise
+
+    def sync(self):
+        """
+        Wait for the shell to be ready, discarding anything printed so far
+        (e.g. by the login scripts).
+        """
+        queue = Queue()
+        self.execute(":", queue)
+        while True:
+            fd, line = queue.get()
+            if isinstance(line, Exception):
+                raise line
+            if fd == 0 and line is None:
+                return
+
+    def close(self):
+        # NOTE: the remote shell exits on end of input, the pump then notices the channel is closed
+        self.channel.shutdown_write()
+
+    def _feed(self, fd, data):
+        lines = (self._pending[fd] + data).split(b"\n")
+        self._pending[fd] = lines.pop()
+        for line in lines:
+            self._dispatch(fd, line)
+
+    def _dispatch(self, fd, line):
+        current = self._current
+        if current is None or fd not in current["left"]:
+            return
+        queue = current["queue"]
+        match = _SENTINEL_RES[fd].search(line)
+        if match is None or match.group("nonce") != current["nonce"]:
+            queue.put( (fd, line.decode('utf-8').rstrip("\n\r")) )
+            return
+        head = line[:match.start()]
+        if head:
+            queue.put( (fd, head.decode('utf-8').rstrip("\n\r")) )
+        queue.put( (fd, None) )
+        if fd == 1:
+            queue.put( (0, int(match.group("exit_code"))) )
+        current["left"].discard(fd)
+        if not current["left"]:
+            queue.put( (0, None) )
+            self._current = None
+            self._idle.release()
+
+    def pump(self):
+        eof = self.channel.eof_received or self.channel.closed
+        active = False
+        if self.channel.recv_ready():
+            self._feed(1, self.channel.recv(self.chunk_size))
+            active = True
+        if self.channel.recv_stderr_ready():
+            self._feed(2, self.channel.recv_stderr(self.chunk_size))
+            active = True
+        current = self._current
+        if active:
+            if current is not None:
+                current["last_activity"] = monotonic()
+        elif eof:
+            raise EOFError("interactive shell channel was closed")
+        elif current is not None and current["timeout"] is not None and monotonic() - current["last_activity"] > current["timeout"]:
+            # NOTE: the running command cannot be interrupted, the shell cannot be reused after that
+            self.channel.close()
+            raise SocketTimeout("Command execution timed out.")
+        return False
+
+    def fail(self, error):
+        # NOTE: the reader is no longer pumped, later commands must not be sent to the shell
+        self.channel.close()
+        current = self._current
+        if current is not None:
+            current["queue"].put( (1, error) )
+            self._current = None
+            self._idle.release()
+
+
+class ChannelPump(Thread):
+    """
+    Drive the readers of any number of channels from a single thread, using
+    a selector (epoll on Linux) on the channels. Readers are pumped as soon
+    as their channel is readable, and all of them are swept every
+    `poll_interval` seconds to catch exit statuses and timeouts. Readers
+    which reached EOF are polled every `eof_poll_interval` seconds until
+    their exit status arrives.
+    """
+
+    def __init__(self, poll_interval=.1, eof_poll_interval=.005):
+        super(ChannelPump, self).__init__(daemon=True)
+        self.poll_interval = poll_interval
+        self.eof_poll_interval = eof_poll_interval
+        self._selector = DefaultSelector()
+        self._registrations = Queue()
+        self._wakeup_r, self._wakeup_w = pipe()
+        self._selector.register(self._wakeup_r, EVENT_READ)
+        self._readers = set()
+        self._draining = set()
+        self.start()
+
+    def register(self, reader):
+        self._registrations.put(reader)
+        write(self._wakeup_w, b"x")
+
+    def _unselect(self, reader):
+        if reader.fd is not None:
+            self._selector.unregister(reader.fd)
+            reader.fd = None
+
+    def _pump(self, reader):
+        try:
+            finished = reader.pump()
+        except Exception as e:
+            reader.fail(e)
+            finished = True
+        if finished:
+            self._unselect(reader)
+            self._readers.discard(reader)
+            self._draining.discard(reader)
+        elif reader.channel.eof_received and not (reader.channel.recv_ready() or reader.channel.recv_stderr_ready()):
+            # NOTE: the pipe of a channel stays readable after EOF, and is not woken up when the
+            #       exit status arrives, so such readers are polled instead
+            self._unselect(reader)
+            self._draining.add(reader)
+
+    def run(self):
+        last_sweep = monotonic()
+        while True:
+            ready = []
+            timeout = self.eof_poll_interval if self._draining else self.poll_interval
+            for key, _ in self._selector.select(timeout):
+                if key.fd == self._wakeup_r:
+                    read(self._wakeup_r, 4096)
+                else:
+                    ready.append(key.data)
+            while not self._registrations.empty():
+                reader = self._registrations.get()
+                try:
+                    # NOTE: register the fd itself, the channel may be closed (and its pipe gone) before being unregistered
+                    fd = reader.channel.fileno()
+                    self._selector.register(fd, EVENT_READ, reader)
+                except Exception as e:
+                    reader.fail(e)
+                    continue
+                reader.fd = fd
+                self._readers.add(reader)
+                ready.append(reader)
+            ready.extend(self._draining)
+            if monotonic() - last_sweep >= self.poll_interval:
+                ready = list(self._readers)
+                last_sweep = monotonic()
+            for reader in ready:
+                if reader in self._readers:
+                    self._pump(reader)
 
 
 class PrefixedStreamReader(Thread):
 
     @staticmethod
-    def wrap_command(command, environment, cwd=None):
-        result = command
-        for var, val in environment.items():
-            result = "%s=%s; " % (var, val) + result
-        if cwd:
-            result = ("cd \"%s\"; " % cwd) + result
+    def wrap_command(command, env_prefix="", cwd=None):
+        result = change_directory(cwd) + env_prefix + command
         prefix_filter = 'while IFS= read -r line || [ -n "$line" ]; do echo %s"$line"; done'
         out_filter = prefix_filter % "OUT-"
         err_filter = prefix_filter % "ERR-"